@@ -1,15 +1,17 @@
+import asyncio
+import aiohttp
+import calendar
 import feedparser
-import requests
 import sqlite3
 import hashlib
-import re
-import json
+import itertools
+import orjson
 import os
 import logging
 import signal
 import sys
-from bs4 import BeautifulSoup
-import time
+from lxml import html as lxml_html
+from pybloom_live import ScalableBloomFilter
 from datetime import datetime
 import zoneinfo
 
@@ -22,16 +24,23 @@ DB_PATH = os.getenv("DB_PATH", "rss_history.db")
 TZ_NAME = os.getenv("TZ", "UTC")
 DEFAULT_PRIORITY = "3"
 USER_AGENT = os.getenv("USER_AGENT", "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-
+NTFY_MAX_CONCURRENCY = 8
+# Feeds are newest-first; with at most 3 sends per feed per run there is
+# no point hashing and checking hundreds of older entries
+MAX_SCAN_ENTRIES = 20
+
+# Resolved once; ZoneInfo lookups are cached but not free per call
+_LOCAL_TZ = zoneinfo.ZoneInfo(TZ_NAME)
+_UTC = zoneinfo.ZoneInfo("UTC")
 # Logging setup
 def get_now():
     """Returns the current time in the configured timezone."""
-    return datetime.now(zoneinfo.ZoneInfo(TZ_NAME))
+    return datetime.now(_LOCAL_TZ)
 
 class TZFormatter(logging.Formatter):
     """Custom logging formatter that respects the configured timezone."""
     def formatTime(self, record, datefmt=None):
-        dt = datetime.fromtimestamp(record.created, zoneinfo.ZoneInfo(TZ_NAME))
+        dt = datetime.fromtimestamp(record.created, _LOCAL_TZ)
         if datefmt:
             return dt.strftime(datefmt)
         return dt.isoformat(sep=' ', timespec='seconds')
@@ -47,6 +56,7 @@ for handler in logging.root.handlers:
     handler.setFormatter(TZFormatter('%(asctime)s - [%(levelname)s] - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
 
 db_conn = None
+seen_bloom = None
 
 
 def signal_handler(sig, frame):
@@ -72,8 +82,39 @@ def init_db():
     if not os.path.exists(db_dir):
         os.makedirs(db_dir, exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
+    # WAL + NORMAL batches fsyncs instead of paying one per commit;
+    # losing the last few seconds of dedupe state on crash is acceptable
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    # WITHOUT ROWID stores the 16-byte hash directly in the table B-tree:
+    # one tree instead of rowid table + implicit PK index
+    schema = ("(hash BLOB PRIMARY KEY, "
+              "created_at DATETIME DEFAULT CURRENT_TIMESTAMP) WITHOUT ROWID")
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name='seen_entries'").fetchone()
+    if row is None:
+        conn.execute(f"CREATE TABLE seen_entries {schema}")
+    elif 'WITHOUT ROWID' not in row[0]:
+        # Migrate a legacy rowid table; old hex TEXT hashes become BLOBs
+        conn.execute(f"CREATE TABLE seen_entries_v2 {schema}")
+        migrated = []
+        for h, created in conn.execute("SELECT hash, created_at FROM seen_entries"):
+            if isinstance(h, str):
+                try:
+                    h = bytes.fromhex(h)
+                except ValueError:
+                    h = h.encode()
+            migrated.append((h, created))
+        conn.executemany(
+            "INSERT OR IGNORE INTO seen_entries_v2 (hash, created_at) VALUES (?, ?)", migrated)
+        conn.execute("DROP TABLE seen_entries")
+        conn.execute("ALTER TABLE seen_entries_v2 RENAME TO seen_entries")
+        logging.info(f"Migrated {len(migrated)} seen entries to WITHOUT ROWID schema.")
     conn.execute(
-        "CREATE TABLE IF NOT EXISTS seen_entries (hash TEXT PRIMARY KEY, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        "CREATE TABLE IF NOT EXISTS feed_meta (url TEXT PRIMARY KEY, etag TEXT, modified TEXT)")
     conn.commit()
     return conn
 
@@ -83,9 +124,10 @@ def format_local_date(entry):
     try:
         parsed_time = entry.get("published_parsed", entry.get("updated_parsed"))
         if parsed_time:
-            # Convert feed time (usually UTC) to local timezone
-            dt_utc = datetime.fromtimestamp(time.mktime(parsed_time), zoneinfo.ZoneInfo("UTC"))
-            local_dt = dt_utc.astimezone(zoneinfo.ZoneInfo(TZ_NAME))
+            # feedparser normalizes parsed times to UTC; timegm interprets the
+            # struct as UTC (mktime wrongly applied the host timezone)
+            dt_utc = datetime.fromtimestamp(calendar.timegm(parsed_time), _UTC)
+            local_dt = dt_utc.astimezone(_LOCAL_TZ)
             return local_dt.strftime('%Y-%m-%d %H:%M:%S')
     except Exception:
         pass
@@ -96,26 +138,83 @@ def clean_html_content(html_content, entry):
     """Cleans HTML content, extracts description and potential image."""
     if not html_content:
         return "", None
-    soup = BeautifulSoup(html_content, "html.parser")
 
-    # Image extraction based on media_content, enclosures or img tag
+    # Image extraction based on media_content or enclosures is free;
+    # falling back to an <img> tag requires parsing below
     img_url = None
     if 'media_content' in entry and len(entry.media_content) > 0:
         img_url = entry.media_content[0]['url']
     elif 'enclosures' in entry and len(entry.enclosures) > 0:
         img_url = entry.enclosures[0]['href']
+
+    content_type = entry.get('summary_detail', {}).get('type', '')
+    if content_type == 'text/plain' or '<' not in html_content:
+        # Already plain text: no need to build a parse tree
+        text = html_content
     else:
-        img_tag = soup.find("img")
-        if img_tag and img_tag.has_attr("src"):
-            img_url = img_tag["src"]
+        # lxml.html goes straight to libxml2: parse, img lookup and text
+        # extraction all run in C without the BeautifulSoup tree on top
+        try:
+            doc = lxml_html.fromstring(html_content)
+            if img_url is None:
+                img_tag = doc.find('.//img')
+                if img_tag is not None and img_tag.get('src'):
+                    img_url = img_tag.get('src')
+            text = doc.text_content()
+        except Exception:
+            text = html_content
 
-    text = soup.get_text(separator=" ")
-    text = re.sub(r'\s+', ' ', text).strip()
+    # split/join collapses all whitespace in one pass of C string code
+    text = ' '.join(text.split())
     short_desc = (text[:250] + '...') if len(text) > 250 else text
     return short_desc, img_url
 
 
-def send_ntfy(session, entry, source_name, custom_icon, topic, priority, delay_str):
+async def fetch_feed(session, url, etag=None, modified=None):
+    """Downloads and parses a feed; returns (feed, etag, modified).
+
+    Sends conditional headers when validators from a previous cycle are
+    known; feed is None when the server answers 304 Not Modified.
+    """
+    headers = {"User-Agent": USER_AGENT}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    async with session.get(url, headers=headers,
+                           timeout=aiohttp.ClientTimeout(total=30)) as resp:
+        if resp.status == 304:
+            return None, etag, modified
+        resp.raise_for_status()
+        data = await resp.read()
+        new_etag = resp.headers.get("ETag")
+        new_modified = resp.headers.get("Last-Modified")
+        # Hand the HTTP headers through so feedparser still sees the
+        # declared content type / charset despite parsing raw bytes
+        resp_headers = {k.lower(): v for k, v in resp.headers.items()}
+    # feedparser is CPU-bound (regex/XML), run it on a worker thread
+    loop = asyncio.get_running_loop()
+    feed = await loop.run_in_executor(
+        None, lambda: feedparser.parse(data, response_headers=resp_headers))
+    return feed, new_etag, new_modified
+
+
+def build_feed_headers(priority, custom_icon):
+    """Builds the ntfy headers that are constant for a whole feed."""
+    headers = {
+        "Authorization": f"Bearer {NTFY_TOKEN}",
+        "User-Agent": USER_AGENT,
+        "Markdown": "yes",
+        "Tags": "newspaper",
+        "Priority": str(priority)
+    }
+    if custom_icon:
+        headers["Icon"] = custom_icon
+    return headers
+
+
+async def send_ntfy(session, semaphore, entry, source_name, source_prefix,
+                    post_url, base_headers, priority, delay_str):
     """Sends a notification to the ntfy server."""
     title = entry.get("title", "No Title")
     link = entry.get("link", "#")
@@ -126,65 +225,134 @@ def send_ntfy(session, entry, source_name, custom_icon, topic, priority, delay_s
     short_desc, image_url = clean_html_content(content, entry)
     local_date_str = format_local_date(entry)
 
-    headers = {
-        "Authorization": f"Bearer {NTFY_TOKEN}",
-        "User-Agent": USER_AGENT,
-        "Title": title.encode('utf-8'),
-        "Click": link,
-        "Markdown": "yes",
-        "Tags": "newspaper",
-        "Priority": str(priority),
-        "X-Publish-Date": local_date_str
-    }
-
+    # Only the per-entry headers are added on top of the shared feed set
+    headers = dict(base_headers)
+    headers["Title"] = title
+    headers["Click"] = link
+    headers["X-Publish-Date"] = local_date_str
     if delay_str:
         headers["Delay"] = delay_str
-    if custom_icon:
-        headers["Icon"] = custom_icon
     if image_url:
         headers["Attach"] = image_url
 
-    message = f"**Source:** {source_name}\n**Local Time:** {local_date_str}\n\n{short_desc}\n\n[Read on Website]({link})"
+    message = f"{source_prefix}{local_date_str}\n\n{short_desc}\n\n[Read on Website]({link})"
 
     try:
-        r = session.post(f"{BASE_URL}/{topic}", data=message.encode('utf-8'), headers=headers, timeout=20)
-        r.raise_for_status()
+        async with semaphore:
+            async with session.post(post_url, data=message.encode('utf-8'),
+                                    headers=headers, timeout=aiohttp.ClientTimeout(total=20)) as r:
+                r.raise_for_status()
         logging.info(f"Notification sent: [{source_name}] - {title} [P:{priority}]")
     except Exception as e:
         logging.error(f"Error during ntfy dispatch: {e}")
 
 
-def process_config_file(session, file_path, cursor, conn):
-    """Processes a configuration JSON file containing feeds."""
-    topic = os.path.splitext(os.path.basename(file_path))[0]
+# Parsed configs keyed by path; invalidated when the file's mtime changes
+_config_cache = {}
+
+
+def load_config_file(file_path):
+    """Loads a configuration JSON file containing feeds, cached per mtime."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            feeds = json.load(f)
+        mtime = os.stat(file_path).st_mtime_ns
+        cached = _config_cache.get(file_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(file_path, 'rb') as f:
+            feeds = orjson.loads(f.read())
+        _config_cache[file_path] = (mtime, feeds)
+        return feeds
     except Exception as e:
         logging.error(f"Error loading configuration ({file_path}): {e}")
-        return
+        return None
+
+
+def entry_digest(topic, entry):
+    """Computes the dedupe hash for a feed entry within a topic."""
+    # Robust entry identification; 'or' keeps the fallback lookups lazy,
+    # unlike dict.get defaults which are always evaluated
+    entry_id = entry.get('id') or entry.get('link') or 'unknown_id'
+    # Dedupe only, not security: blake2b-128 is faster than SHA-256
+    # on short IDs and halves the bytes stored per row
+    return hashlib.blake2b(f"{topic}_{entry_id}".encode(), digest_size=16).digest()
+
+
+def load_seen_bloom(conn):
+    """Builds an in-memory bloom filter over all stored entry hashes.
+
+    A miss means the entry is definitely new, so the common case never
+    touches SQLite; the rare positives are verified with a SELECT.
+    """
+    bloom = ScalableBloomFilter(initial_capacity=100_000, error_rate=0.001)
+    for (h,) in conn.execute("SELECT hash FROM seen_entries"):
+        bloom.add(h)
+    return bloom
 
+
+def load_feed_meta(cursor):
+    """Returns url -> (etag, modified) validators stored by earlier cycles."""
+    cursor.execute("SELECT url, etag, modified FROM feed_meta")
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+
+def load_seen_hashes(cursor, hashes):
+    """Returns the subset of candidate hashes already present in seen_entries."""
+    if not hashes:
+        return set()
+    placeholders = ",".join("?" * len(hashes))
+    cursor.execute(f"SELECT hash FROM seen_entries WHERE hash IN ({placeholders})", hashes)
+    return {row[0] for row in cursor.fetchall()}
+
+
+async def process_config_file(session, semaphore, file_path, feeds, parsed_feeds, cursor, conn):
+    """Processes the feeds of one configuration file using pre-fetched feed data."""
+    topic = os.path.splitext(os.path.basename(file_path))[0]
+
+    # Hash every candidate entry up front so the seen-lookup is a single
+    # SELECT per config file instead of one round-trip per entry
+    candidates = []
+    all_hashes = []
     for f_conf in feeds:
+        feed = parsed_feeds.get(f_conf.get('url'))
+        if feed is None or isinstance(feed, Exception):
+            candidates.append((f_conf, feed, []))
+            continue
+        # The batched seen-SELECT below needs the whole window's hashes, so
+        # each scanned entry is hashed exactly once, and none beyond the cap
+        pairs = [(entry, entry_digest(topic, entry))
+                 for entry in itertools.islice(feed.entries, MAX_SCAN_ENTRIES)]
+        # Only bloom-positive hashes need SQL verification; misses are new
+        all_hashes.extend(h for _, h in pairs if h in seen_bloom)
+        candidates.append((f_conf, feed, pairs))
+    seen = load_seen_hashes(cursor, all_hashes)
+    new_hashes = []
+    send_tasks = []
+
+    for f_conf, feed, pairs in candidates:
         source_name = f_conf.get('name', 'Unknown')
         try:
             logging.info(f"Checking feed: {source_name} ({f_conf['url']})")
-            feed = feedparser.parse(f_conf['url'])
+            if isinstance(feed, Exception):
+                logging.error(f"Error fetching feed ({source_name}): {feed}")
+                continue
+            if feed is None:
+                logging.info(f"Feed not modified since last cycle: {source_name}")
+                continue
             prio = f_conf.get('priority', DEFAULT_PRIORITY)
+            # Constant across the whole feed: build once, reuse per entry
+            post_url = f"{BASE_URL}/{topic}"
+            base_headers = build_feed_headers(prio, f_conf.get('icon'))
+            source_prefix = f"**Source:** {f_conf['name']}\n**Local Time:** "
             sent_in_batch = 0
             new_entries_found = 0
 
-            for entry in feed.entries:
+            for entry, entry_hash in pairs:
                 # Send at most 3 new entries per feed per run
                 if sent_in_batch >= 3:
                     logging.warning(f"Batch limit reached for {source_name}. Skipping remaining entries.")
                     break
 
-                # Robust entry identification
-                entry_id = entry.get('id', entry.get('link', 'unknown_id'))
-                entry_hash = hashlib.sha256(f"{topic}_{entry_id}".encode()).hexdigest()
-
-                cursor.execute("SELECT 1 FROM seen_entries WHERE hash=?", (entry_hash,))
-                if not cursor.fetchone():
+                if entry_hash not in seen:
                     # Calculate delay based on priority (flood protection)
                     p = int(prio)
                     delay = None
@@ -196,13 +364,16 @@ def process_config_file(session, file_path, cursor, conn):
                         else:
                             delay = f"{sent_in_batch * 10 + 15}m"
 
-                    send_ntfy(session, entry, f_conf['name'], f_conf.get('icon'), topic, prio, delay)
+                    send_tasks.append(asyncio.create_task(
+                        send_ntfy(session, semaphore, entry, f_conf['name'], source_prefix,
+                                  post_url, base_headers, prio, delay)))
 
-                    cursor.execute("INSERT INTO seen_entries (hash) VALUES (?)", (entry_hash,))
-                    conn.commit()
+                    new_hashes.append((entry_hash,))
+                    seen.add(entry_hash)
+                    seen_bloom.add(entry_hash)
                     sent_in_batch += 1
                     new_entries_found += 1
-            
+
             if new_entries_found == 0:
                 logging.info(f"No new entries for {source_name}.")
             else:
@@ -211,33 +382,90 @@ def process_config_file(session, file_path, cursor, conn):
         except Exception as e:
             logging.error(f"Error processing feed ({f_conf.get('name', 'Unknown')}): {e}")
 
+    # Let the file's notifications run concurrently, bounded by the semaphore
+    if send_tasks:
+        await asyncio.gather(*send_tasks)
 
-def main():
-    """Main execution cycle that iterates over configuration files."""
-    global db_conn
+    # One batched write + commit per config file instead of one per entry
+    if new_hashes:
+        with conn:
+            cursor.executemany("INSERT OR IGNORE INTO seen_entries (hash) VALUES (?)", new_hashes)
+
+
+async def main(session):
+    """Main execution cycle that fetches all feeds concurrently, then processes them."""
+    global db_conn, seen_bloom
     if not os.path.exists(CONFIG_DIR):
         logging.error(f"Configuration directory '{CONFIG_DIR}' not found.")
         return
-    db_conn = init_db()
+    # One long-lived connection for the daemon; re-opening every cycle
+    # would re-pay connection setup and the pragmas from init_db
+    if db_conn is None:
+        db_conn = init_db()
+        seen_bloom = load_seen_bloom(db_conn)
     cursor = db_conn.cursor()
     logging.info("Starting synchronization cycle...")
-    with requests.Session() as session:
-        config_files = sorted([f for f in os.listdir(CONFIG_DIR) if f.endswith('.json')])
-        if not config_files:
-            logging.warning(f"No .json configuration files found in {CONFIG_DIR}")
-        for filename in config_files:
-            logging.info(f"Processing config file: {filename}")
-            process_config_file(session, os.path.join(CONFIG_DIR, filename), cursor, db_conn)
+    config_files = sorted([f for f in os.listdir(CONFIG_DIR) if f.endswith('.json')])
+    if not config_files:
+        logging.warning(f"No .json configuration files found in {CONFIG_DIR}")
+
+    # Local file I/O stays synchronous; only network work goes async
+    configs = []
+    for filename in config_files:
+        file_path = os.path.join(CONFIG_DIR, filename)
+        feeds = load_config_file(file_path)
+        if feeds is not None:
+            configs.append((file_path, feeds))
+
+    # Download every feed of every config file concurrently, using the
+    # validators from the previous cycle so unchanged feeds cost a 304
+    feed_meta = load_feed_meta(cursor)
+    # Config files may share feed URLs; fetch and parse each URL once
+    # per cycle and let every file read from the same parsed result
+    urls = list(dict.fromkeys(
+        f_conf['url'] for _, feeds in configs for f_conf in feeds if 'url' in f_conf))
+    results = await asyncio.gather(
+        *(fetch_feed(session, url, *feed_meta.get(url, (None, None))) for url in urls),
+        return_exceptions=True)
+
+    parsed_feeds = {}
+    meta_updates = []
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            parsed_feeds[url] = result
+            continue
+        feed, etag, modified = result
+        parsed_feeds[url] = feed
+        if feed is not None and (etag or modified):
+            meta_updates.append((url, etag, modified))
+    if meta_updates:
+        with db_conn:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO feed_meta (url, etag, modified) VALUES (?, ?, ?)",
+                meta_updates)
+
+    semaphore = asyncio.Semaphore(NTFY_MAX_CONCURRENCY)
+    for file_path, feeds in configs:
+        logging.info(f"Processing config file: {os.path.basename(file_path)}")
+        await process_config_file(session, semaphore, file_path, feeds, parsed_feeds, cursor, db_conn)
     logging.info("Synchronization cycle completed.")
-    db_conn.close()
 
 
-if __name__ == "__main__":
+async def runner():
+    """Long-lived daemon driver: one event loop, HTTP session and database."""
     sync_interval = int(os.getenv("SYNC_INTERVAL", "600"))
     logging.info(f"Service started. Interval: {sync_interval}s")
-    while True:
-        try:
-            main()
-        except Exception as e:
-            logging.error(f"Main loop crashed but restarting: {e}")
-        time.sleep(sync_interval)
+    # Sized so concurrent feed fetches and the bounded ntfy sends all get
+    # keep-alive connections; DNS answers are cached across fetches
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while True:
+            try:
+                await main(session)
+            except Exception as e:
+                logging.error(f"Main loop crashed but restarting: {e}")
+            await asyncio.sleep(sync_interval)
+
+
+if __name__ == "__main__":
+    asyncio.run(runner())